@@ -1,73 +1,139 @@
 # account-service/main.py
 
 from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import Column, Integer, String, Float, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from sqlalchemy import Column, Integer, String, Float, select, exists, bindparam, lambda_stmt
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
 from jose import jwt, JWTError
+from contextlib import asynccontextmanager
+from cachetools import TLRUCache, cached
+import hashlib
+import threading
+import time
 import os
 
 # ENV
-DB_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
+DB_URL = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
 SECRET_KEY = os.getenv("JWT_SECRET", "bankstack-secret-key")
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 
 # DB
 Base = declarative_base()
-engine = create_engine(DB_URL)
-SessionLocal = sessionmaker(bind=engine)
+engine = create_async_engine(
+    DB_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_timeout=30,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    pool_use_lifo=True,
+)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_schema():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def run_schema_init():
+    try:
+        await init_schema()
+    finally:
+        await engine.dispose()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("RUN_SCHEMA_INIT") == "1":
+        await init_schema()
+    yield
+    await engine.dispose()
 
 # App
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, root_path=os.getenv("ROOT_PATH", ""))
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+_ACCOUNT_TPL = templates.get_template("account.html")
+
+# Error handlers
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=getattr(exc, "headers", None))
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
 
 class Account(Base):
     __tablename__ = "accounts"
     id = Column(Integer, primary_key=True)
-    email = Column(String, unique=True)
+    email = Column(String, unique=True, index=True)
     account_type = Column(String)
     balance = Column(Float, default=1000.0)
 
-@app.on_event("startup")
-def init():
-    Base.metadata.create_all(bind=engine)
+_ACCOUNT_BY_EMAIL = lambda_stmt(lambda: select(Account).where(Account.email == bindparam("email")))
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def get_email(request: Request):
-    token = request.cookies.get("access_token")
+# JWT cache
+JWT_CACHE_TTL = 30
+_JWT_CACHE = TLRUCache(
+    maxsize=10000,
+    ttu=lambda _key, payload, now: min(now + JWT_CACHE_TTL, payload.get("exp", now + JWT_CACHE_TTL)),
+    timer=time.time,
+)
+_JWT_CACHE_LOCK = threading.Lock()
+
+@cached(_JWT_CACHE, key=lambda token: hashlib.sha256(token.encode()).digest()[:16], lock=_JWT_CACHE_LOCK)
+def _decode_cached(token: str):
+    # JWTError propagates, so invalid tokens are never cached
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+def _get_token(request: Request):
+    # same result as request.cookies.get("access_token"), minus unquoting,
+    # which JWT values never need
+    cookie = request.headers.get("cookie")
+    if not cookie:
+        return None
+    start = cookie.rfind("access_token=")
+    while start > 0 and cookie[:start].rstrip(" ")[-1:] not in ("", ";"):
+        start = cookie.rfind("access_token=", 0, start)
+    if start < 0:
+        return None
+    start += len("access_token=")
+    end = cookie.find(";", start)
+    return (cookie[start:] if end < 0 else cookie[start:end]).strip()
+
+async def get_email(request: Request) -> str:
+    token = _get_token(request)
     if not token:
         raise HTTPException(status_code=401, detail="Unauthorized")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
+        return _decode_cached(token).get("sub")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 @app.get("/", response_class=HTMLResponse)
-def home():
+async def home():
     return HTMLResponse("<h3>Account Service is up!</h3>")
 
 @app.get("/ui/account", response_class=HTMLResponse)
-def account_ui(request: Request, db: Session = Depends(get_db)):
-    email = get_email(request)
-    account = db.query(Account).filter(Account.email == email).first()
-    return templates.TemplateResponse("account.html", {"request": request, "account": account})
+async def account_ui(request: Request, email: str = Depends(get_email), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(_ACCOUNT_BY_EMAIL, {"email": email})
+    account = result.scalar_one_or_none()
+    return HTMLResponse(_ACCOUNT_TPL.render(request=request, account=account))
 
 @app.post("/ui/account")
-def create_account_ui(request: Request, account_type: str = Form(...), db: Session = Depends(get_db)):
-    email = get_email(request)
-    if not db.query(Account).filter(Account.email == email).first():
+async def create_account_ui(account_type: str = Form(...), email: str = Depends(get_email), db: AsyncSession = Depends(get_db)):
+    if not await db.scalar(select(exists().where(Account.email == email))):
         acc = Account(email=email, account_type=account_type)
         db.add(acc)
-        db.commit()
+        await db.commit()
     return RedirectResponse("/ui/account", status_code=302)
 
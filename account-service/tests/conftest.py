@@ -0,0 +1,8 @@
+import os
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main.py mounts static/ and templates/ relative to the working directory
+os.chdir(SERVICE_DIR)
+sys.path.insert(0, SERVICE_DIR)
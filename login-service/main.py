@@ -1,109 +1,247 @@
 # login-service/main.py
 
 from fastapi import FastAPI, Request, Form, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import Column, Integer, String, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
-from passlib.context import CryptContext
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from sqlalchemy import Column, Integer, String, select, exists, update, bindparam, lambda_stmt
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
+import bcrypt
 from jose import jwt, JWTError
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from cachetools import TLRUCache, TTLCache, cached
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
 import os
 
 # ENV + DB
-DB_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
+DB_URL = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
 SECRET_KEY = os.getenv("JWT_SECRET", "bankstack-secret-key")
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 # SQLAlchemy
 Base = declarative_base()
-engine = create_engine(DB_URL)
-SessionLocal = sessionmaker(bind=engine)
+engine = create_async_engine(
+    DB_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_timeout=30,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    pool_use_lifo=True,
+)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_schema():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def run_schema_init():
+    try:
+        await init_schema()
+    finally:
+        await engine.dispose()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("RUN_SCHEMA_INIT") == "1":
+        await init_schema()
+    yield
+    await engine.dispose()
 
 # App
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+_REGISTER_TPL = templates.get_template("register.html")
+_LOGIN_TPL = templates.get_template("login.html")
+_DASHBOARD_TPL = templates.get_template("dashboard.html")
+
+# Error handlers
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=getattr(exc, "headers", None))
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
 
 # Password
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_ARGON2 = PasswordHasher(
+    time_cost=int(os.getenv("ARGON2_TIME_COST", "1")),
+    memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "47104")),
+    parallelism=int(os.getenv("ARGON2_PARALLELISM", "1")),
+)
+_BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+def hash_password(plain: str) -> str:
+    return _ARGON2.hash(plain)
+
+def verify_and_update(plain: str, hashed: str):
+    # returns (verified, new_hash or None)
+    if hashed.startswith(_BCRYPT_PREFIXES):
+        # bcrypt only sees the first 72 bytes, as passlib did when it made these
+        if not bcrypt.checkpw(plain.encode()[:72], hashed.encode()):
+            return False, None
+        return True, _ARGON2.hash(plain)
+    try:
+        _ARGON2.verify(hashed, plain)
+    except (VerificationError, InvalidHash):
+        return False, None
+    return True, _ARGON2.hash(plain) if _ARGON2.check_needs_rehash(hashed) else None
+
+# Hashing pool, per worker: the CPUs split across WEB_CONCURRENCY workers
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", "0")) or max(1, _CPUS // int(os.getenv("WEB_CONCURRENCY", "1")))
+_HASH_POOL = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE, thread_name_prefix="pwhash")
 
 # Models
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
-    email = Column(String, unique=True, nullable=False)
+    email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
 
+_USER_BY_EMAIL = lambda_stmt(
+    lambda: select(User.id, User.email, User.hashed_password).where(User.email == bindparam("email"))
+)
+
 # DB Dep
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # JWT
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+_HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+if ALGORITHM not in _HMAC_DIGESTS:
+    raise RuntimeError(f"JWT_ALGORITHM={ALGORITHM!r} is not supported; use one of {', '.join(_HMAC_DIGESTS)}")
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+def _b64url(raw: bytes) -> bytes:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
 
-def verify_password(plain, hashed):
-    return pwd_context.verify(plain, hashed)
+_JWT_HEADER_B64 = _b64url(json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode())
+_JWT_HMAC = hmac.new(SECRET_KEY.encode(), digestmod=_HMAC_DIGESTS[ALGORITHM])
 
-def get_current_user(request: Request, db: Session = Depends(get_db)):
-    token = request.cookies.get("access_token")
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    to_encode["exp"] = int(time.time()) + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(json.dumps(to_encode, separators=(",", ":")).encode())
+    mac = _JWT_HMAC.copy()
+    mac.update(signing_input)
+    return (signing_input + b"." + _b64url(mac.digest())).decode()
+
+# User cache: per worker, hits only; other workers may serve a row for up to
+# 60s after it changes (e.g. redo a bcrypt -> Argon2 upgrade on next login)
+CachedUser = namedtuple("CachedUser", ["id", "email", "hashed_password"])
+_USER_CACHE = TTLCache(maxsize=10000, ttl=60)
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    user = _USER_CACHE.get(email)
+    if user is None:
+        result = await db.execute(_USER_BY_EMAIL, {"email": email})
+        row = result.first()
+        if row is None:
+            return None
+        user = _USER_CACHE[email] = CachedUser(*row)
+    return user
+
+# JWT cache
+JWT_CACHE_TTL = 30
+_JWT_CACHE = TLRUCache(
+    maxsize=10000,
+    ttu=lambda _key, payload, now: min(now + JWT_CACHE_TTL, payload.get("exp", now + JWT_CACHE_TTL)),
+    timer=time.time,
+)
+_JWT_CACHE_LOCK = threading.Lock()
+
+@cached(_JWT_CACHE, key=lambda token: hashlib.sha256(token.encode()).digest()[:16], lock=_JWT_CACHE_LOCK)
+def _decode_cached(token: str):
+    # JWTError propagates, so invalid tokens are never cached
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+def _get_token(request: Request):
+    # same result as request.cookies.get("access_token"), minus unquoting,
+    # which JWT values never need
+    cookie = request.headers.get("cookie")
+    if not cookie:
+        return None
+    start = cookie.rfind("access_token=")
+    while start > 0 and cookie[:start].rstrip(" ")[-1:] not in ("", ";"):
+        start = cookie.rfind("access_token=", 0, start)
+    if start < 0:
+        return None
+    start += len("access_token=")
+    end = cookie.find(";", start)
+    return (cookie[start:] if end < 0 else cookie[start:end]).strip()
+
+async def optional_jwt(request: Request) -> Optional[str]:
+    # the token's subject, or None when the cookie is missing or invalid
+    token = _get_token(request)
     if not token:
-        raise HTTPException(status_code=401, detail="Missing token")
+        return None
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return get_user_by_email(db, payload.get("sub"))
+        return _decode_cached(token).get("sub")
     except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-@app.on_event("startup")
-def startup():
-    Base.metadata.create_all(bind=engine)
+        return None
 
 @app.get("/register", response_class=HTMLResponse)
-def get_register(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request})
+async def get_register(request: Request):
+    return HTMLResponse(_REGISTER_TPL.render(request=request))
 
 @app.post("/register")
-def post_register(email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    if get_user_by_email(db, email):
+async def post_register(email: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    if await db.scalar(select(exists().where(User.email == email))):
         raise HTTPException(status_code=400, detail="User exists")
-    hashed_pw = pwd_context.hash(password)
+    hashed_pw = await asyncio.get_running_loop().run_in_executor(_HASH_POOL, hash_password, password)
     db.add(User(email=email, hashed_password=hashed_pw))
-    db.commit()
+    await db.commit()
     return RedirectResponse("/login", status_code=302)
 
 @app.get("/login", response_class=HTMLResponse)
-def login_form(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+async def login_form(request: Request):
+    return HTMLResponse(_LOGIN_TPL.render(request=request))
 
 @app.post("/login")
-def post_login(request: Request, email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    user = get_user_by_email(db, email)
-    if not user or not verify_password(password, user.hashed_password):
+async def post_login(request: Request, email: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    user = await get_user_by_email(db, email)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    verified, new_hash = await asyncio.get_running_loop().run_in_executor(
+        _HASH_POOL, verify_and_update, password, user.hashed_password
+    )
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     token = create_access_token({"sub": user.email})
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+        await db.commit()
+        _USER_CACHE.pop(user.email, None)
     resp = RedirectResponse("/me", status_code=302)
     resp.set_cookie("access_token", token, httponly=True)
     return resp
 
 @app.get("/me", response_class=HTMLResponse)
-def me(request: Request, db: Session = Depends(get_db)):
-    try:
-        user = get_current_user(request, db)
-        return templates.TemplateResponse("dashboard.html", {"request": request, "email": user.email})
-    except:
+async def me(request: Request, email: Optional[str] = Depends(optional_jwt), db: AsyncSession = Depends(get_db)):
+    # only a missing or invalid token redirects; DB errors surface as 500s
+    if email is None:
+        return RedirectResponse("/login", status_code=302)
+    user = await get_user_by_email(db, email)
+    if not user:
         return RedirectResponse("/login", status_code=302)
+    return HTMLResponse(_DASHBOARD_TPL.render(request=request, email=user.email))
 
@@ -0,0 +1,34 @@
+import pytest
+from starlette.requests import Request
+
+import main
+
+COOKIE_HEADERS = [
+    None,
+    "",
+    "access_token=abc",
+    "  access_token=abc",
+    "a=1; access_token=abc; b=2",
+    "a=1;access_token=abc",
+    "access_token=abc ; x=1",
+    "x=1;  access_token= abc ",
+    "access_token=",
+    "xaccess_token=bad",
+    "xaccess_token=bad; access_token=good",
+    "access_token=good; xaccess_token=bad",
+    "foo=access_token=x",
+    "foo=bar access_token=x",
+    "access_token=a; access_token=b",
+    "access_token=a.b.c; other=access_token=z",
+]
+
+
+def _request(cookie):
+    headers = [] if cookie is None else [(b"cookie", cookie.encode())]
+    return Request({"type": "http", "headers": headers})
+
+
+@pytest.mark.parametrize("cookie", COOKIE_HEADERS)
+def test_get_token_matches_starlette(cookie):
+    request = _request(cookie)
+    assert main._get_token(request) == request.cookies.get("access_token")
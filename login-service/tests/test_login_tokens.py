@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from jose import jwt
+
+import main
+
+
+@pytest.mark.parametrize("claims", [{"sub": "a@b.c"}, {"sub": "ünïcode@b.c", "scope": "x"}])
+def test_create_access_token_matches_jose(claims):
+    token = main.create_access_token(claims)
+    decoded = jwt.decode(token, main.SECRET_KEY, algorithms=[main.ALGORITHM])
+    assert decoded == {**claims, "exp": decoded["exp"]}
+    assert token == jwt.encode(decoded, main.SECRET_KEY, algorithm=main.ALGORITHM)
+
+
+def test_non_hmac_algorithm_fails_at_import():
+    env = {**os.environ, "JWT_ALGORITHM": "RS256"}
+    result = subprocess.run([sys.executable, "-c", "import main"], env=env, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "JWT_ALGORITHM='RS256' is not supported" in result.stderr